@@ -24,81 +24,189 @@ https://karenapp.io/articles/how-to-automate-google-calendar-with-python-using-t
 from __future__ import print_function
 
 import datetime as dt
+import functools
+import numpy as np
 import os.path
 import pandas as pd
+import queue
+import random
+import threading
+import time
 import warnings
-
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+from concurrent.futures import ThreadPoolExecutor
+
+# The Google client libraries are slow to import, so they are only imported
+# inside the functions that use them, when they are actually needed.
+
+# Use the (much faster) Rust-based calamine reader if it's installed
+# (pip install python-calamine, needs pandas >= 2.2), otherwise openpyxl.
+# pandas already opens openpyxl workbooks with read_only=True (streams the
+# rows) and data_only=True (formulas give their cached values, which is what
+# the calendar wants anyway), so no engine_kwargs are needed for it.
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = 'calamine'
+except ImportError:
+    EXCEL_ENGINE = None
+
+# Google credentials, loaded once by get_credentials()
+_creds = None
+_creds_lock = threading.Lock()
 
 # If modifying these scopes, delete the file token.json.
 SCOPES = ['https://www.googleapis.com/auth/calendar']
 
-
-def xlsx_to_calendar(file, sheet=None):
+# Columns of the Excel template, only these are read from the sheet
+TEXT_COLUMNS = ['Summary', 'Description', 'Calendar Name',
+                'Start Time Zone', 'End Time Zone']
+TEMPLATE_COLUMNS = TEXT_COLUMNS + ['Start Date', 'Start Time',
+                                   'End Date', 'End Time']
+# Fields of a df row (besides the calendar 'id') that make up an event
+EVENT_FIELDS = ("summary", "description", "start", "end")
+# Google allows up to 50 calls in a single batch request
+BATCH_SIZE = 50
+# Number of batch requests sent at the same time (more mostly hits rate limits)
+MAX_WORKERS = 4
+# HTTP statuses worth retrying (rate limits, temporary server errors), and
+# how many times to try. 403 is only retried for these reasons, since it is
+# also used for real permission errors.
+RETRY_STATUSES = {403, 429, 500, 503}
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded')
+MAX_RETRIES = 5
+MAX_BACKOFF = 64  # seconds
+
+
+def xlsx_to_calendar(file, sheet=None, service=None):
     """
     Primary function that does everything:
         - connects to Google Calendar
         - converts input .xlsx 'file' to Pandas DataFrame
         - creates the appropriate dictionary (json) for each row
-        - uploads each of these events to Google Calendar
+        - uploads these events to Google Calendar (in batches of 50,
+          several batches at a time)
         
     Inputs:
         file: str of xlsx filename
         sheet: (optional) str of sheet name, otherwise use 1st sheet
+        service: (optional) Google Calendar 'service' to reuse, e.g. when
+                 uploading several sheets in a row
     """
-    print("Connecting to Google Calendar...")
-    service = get_calendar_service()
+    if service is None:
+        print("Connecting to Google Calendar...")
+        service = get_calendar_service()
     print("Converting spreadsheet...")
     df = xlsx_to_df(file, sheet)
     df = df_cal_format(df, service)
     print("Updating Google Calendar...")
-    results = df.apply(create_new_event, axis=1, service=service)
+    records = df[["id", *EVENT_FIELDS]].to_dict(orient="records")
+    results = pd.Series(create_events_batch(records, service), index=df.index)
     print("Success!")
     return results
 
     
 def get_calendar_service():
     """ returns the Google Calendar 'service' """
-    creds = None
-    # The file token.json stores the user's access and refresh tokens, and is
-    # created automatically when the authorization flow completes for the first
-    # time.
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-    # If there are no (valid) credentials available, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                'credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
-        # Save the credentials for the next run
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
+    from googleapiclient.errors import HttpError
 
+    creds = get_credentials()
     try:
-        service = build('calendar', 'v3', credentials=creds)
+        service = build_calendar_service(creds)
         return service
     except HttpError as error:
         print('An error occurred: %s' % error)
 
 
+def build_calendar_service(creds):
+    """ returns a Google Calendar 'service' using the credentials 'creds' """
+    from google_auth_httplib2 import AuthorizedHttp
+    from googleapiclient.discovery import build
+    from googleapiclient.http import build_http
+
+    # One authorized connection for every request made through this service,
+    # httplib2 keeps it alive between requests and accepts gzip responses.
+    http = AuthorizedHttp(creds, http=build_http())
+    # Use the discovery document bundled with googleapiclient (>= 2.0) rather
+    # than downloading it from Google every time.
+    return build('calendar', 'v3', http=http, model=json_model(),
+                 static_discovery=True, cache_discovery=False)
+
+
+@functools.lru_cache(maxsize=1)
+def json_model():
+    """
+    Returns a googleapiclient JsonModel that encodes/decodes request and
+    response bodies with the (much faster) orjson, if it's installed
+    (pip install orjson). Otherwise None, so build() uses its default model.
+    """
+    try:
+        import orjson
+    except ImportError:
+        return None
+    from googleapiclient.model import JsonModel
+
+    class OrjsonModel(JsonModel):
+        def serialize(self, body_value):
+            if (isinstance(body_value, dict) and 'data' not in body_value
+                    and self._data_wrapper):
+                body_value = {'data': body_value}
+            return orjson.dumps(body_value).decode('utf-8')
+
+        def deserialize(self, content):
+            try:
+                body = orjson.loads(content)
+            except orjson.JSONDecodeError:  # not json, let JsonModel handle it
+                return super().deserialize(content)
+            if self._data_wrapper and isinstance(body, dict) and 'data' in body:
+                body = body['data']
+            return body
+
+    return OrjsonModel()
+
+
+def get_credentials():
+    """
+    returns the user's Google credentials, kept in memory so 'token.json'
+    is only read again once they are no longer valid
+    """
+    global _creds
+    from google.auth.transport.requests import Request
+    from google.oauth2.credentials import Credentials
+    from google_auth_oauthlib.flow import InstalledAppFlow
+
+    with _creds_lock:
+        creds = _creds
+        # The file token.json stores the user's access and refresh tokens, and is
+        # created automatically when the authorization flow completes for the first
+        # time.
+        if not (creds and creds.valid) and os.path.exists('token.json'):
+            creds = Credentials.from_authorized_user_file('token.json', SCOPES)
+        # If there are no (valid) credentials available, let the user log in.
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                creds.refresh(Request())
+            else:
+                flow = InstalledAppFlow.from_client_secrets_file(
+                    'credentials.json', SCOPES)
+                creds = flow.run_local_server(port=0)
+            # Save the credentials for the next run
+            with open('token.json', 'w') as token:
+                token.write(creds.to_json())
+        _creds = creds
+        return creds
+
+
 def xlsx_to_df(file, sheet=None):
     """ Inputs xlsx file, outputs df, no reformatting yet """
     # My excel template uses data validation to select items from list, and 
     # read_excel warns that it can't support this. I am ignoring the warning.
     with warnings.catch_warnings():
         warnings.filterwarnings("ignore", message="Data Validation extension is not supported", category=UserWarning)
-        if sheet:
-            df = pd.read_excel(file, sheet_name=sheet)
-        else:
-            df = pd.read_excel(file)
-            
+        # Closed again straight away, so Excel can still save over the file
+        with pd.ExcelFile(file, engine=EXCEL_ENGINE) as xf:
+            df = xf.parse(sheet if sheet else 0,  # 0 is the 1st sheet
+                          usecols=TEMPLATE_COLUMNS,
+                          dtype={col : str for col in TEXT_COLUMNS})
+
     # Remove unicode BOM that is sometimes exported from Excel.
     df.replace(to_replace='\ufeff', value='', regex=True, inplace=True)
     return df
@@ -110,34 +218,81 @@ def df_cal_format(df, service):
     column_dict = {'Summary' : 'summary', 'Description' : 'description'}
     df = df.rename(columns=column_dict)
 
-    # If timezone isn't specified, will use default timezone
+    # Fill in blanks:
+    #   - if timezone isn't specified, will use default timezone
+    #   - so blank descriptions don't say NaN
+    #   - default to Primary calendar
     tz = default_timezone(service)
-    df['Start Time Zone'].fillna(tz, inplace=True)
-    df['End Time Zone'].fillna(tz, inplace=True)
-    df['description'].fillna("", inplace=True)  # So blank descriptions don't say NaN
-    df['Calendar Name'].fillna('Primary', inplace=True)  # default to Primar calendar
+    df = df.fillna({'Start Time Zone' : tz, 'End Time Zone' : tz,
+                    'description' : "", 'Calendar Name' : 'Primary'})
 
     # lookup calendar ids from calendar names
-    calendars = linked_calendars(service)
+    calendars = dict(linked_calendars(service))  # copy, result is cached
     calendars['Primary'] = 'primary'   # can use 'primary' instead of email address/id
-    df['id'] = df['Calendar Name'].map(calendars)
+    # (each distinct name is looked up once, unknown names get None)
+    names = pd.Categorical(df['Calendar Name'])
+    ids = np.array([calendars.get(name) for name in names.categories], dtype=object)
+    df['id'] = ids[names.codes]
+
+    # Check every row before anything is uploaded
+    validate_events(df)
 
     # Create start/end information
-    df[["start", "end"]] = df.apply(format_date, axis="columns", 
-                                    result_type='expand').astype("object")  
+    start, end = format_dates(df)
+    df["start"] = pd.Series(start, index=df.index, dtype="object")
+    df["end"] = pd.Series(end, index=df.index, dtype="object")
     
     return df
 
 
+def validate_events(df):
+    """
+    Checks all rows of the formatted df at once, and raises a single
+    ValueError listing every problem (by Excel row number), so nothing is
+    uploaded from a spreadsheet that would fail part way through.
+    """
+    checks = {
+        "missing Start Date" : df['Start Date'].isna(),
+        "unknown (or read-only) Calendar Name" : df['id'].isna(),
+        "Start Time is not a time" : invalid_times(df['Start Time']),
+        "End Time is not a time" : invalid_times(df['End Time']),
+        }
+    timezones = known_timezones()
+    if timezones:  # can't check without the system's timezone database
+        for col in ['Start Time Zone', 'End Time Zone']:
+            checks[f"unknown {col}"] = ~df[col].isin(timezones)
+
+    excel_rows = df.index + 2  # 1 for the header row, 1 as Excel counts from 1
+    problems = [f"  row {row}: {problem}"
+                for problem, bad in checks.items()
+                for row in excel_rows[bad.to_numpy()]]
+    if problems:
+        raise ValueError("Invalid events in spreadsheet:\n" + "\n".join(problems))
+
+
+@functools.lru_cache(maxsize=1)
+def known_timezones():
+    """ set of IANA timezone names (empty if they can't be determined) """
+    try:
+        import zoneinfo
+        return zoneinfo.available_timezones()
+    except ImportError:  # Python < 3.9
+        return set()
+
+
+# The timezone and calendar list rarely change, so they are only looked up
+# once per 'service' (a new service, e.g. after a token refresh, looks again).
+@functools.lru_cache(maxsize=4)
 def default_timezone(service):
     """ return the default timezone (str) of user """
-    settings = service.settings().list().execute()
+    settings = with_retry(service.settings().list().execute)
     return [s['value'] for s in settings['items'] if s['id']=='timezone'][0]
 
-    
+
+@functools.lru_cache(maxsize=4)
 def linked_calendars(service, can_edit=True):
     """ return a dict of linked calendars (that can be edited) """
-    calendars_result = service.calendarList().list().execute()
+    calendars_result = with_retry(service.calendarList().list().execute)
     calendars = calendars_result.get('items', [])  # list of calendars
 
     if can_edit:
@@ -148,53 +303,182 @@ def linked_calendars(service, can_edit=True):
         return { cal['summary'] : cal['id'] for cal in calendars }
 
 
-def format_date(row):
-    """ Input row in df, create appropriate start/end info for google cal """
-    # Check that the "Start Date" is not blank
-    if pd.isna(row["Start Date"]):
-        raise Exception("Event must contain a Start Date")
-    
-    # All-day event
-    if pd.isna(row["Start Time"]):
-        start_date = str(row["Start Date"].date())
-        if pd.isna(row["End Date"]):  # Single-day event
-            end_date = start_date
-        else:
-            end_date = str(row["End Date"].date())  # Multi-day event
-        return [ {"date" : start_date}, {"date" : end_date} ]
- 
-    # Include Start/Stop times
-    if pd.notna(row["Start Time"]): 
-        d = row["Start Date"]  # pd Timestamp format
-        t = row["Start Time"]  # datetime.time format        
-        start_datetime = dt.datetime(d.year, d.month, d.day, t.hour, t.minute)
-
-        if pd.isna(row["End Time"]):  # Default to 1-hour duration
-            end_datetime = start_datetime + dt.timedelta(hours=1)
-        elif pd.isna(row["End Date"]):  # One-day event
-            t = row["End Time"]
-            end_datetime = dt.datetime(d.year, d.month, d.day, t.hour, t.minute)
-        else:  # Specific start/stop times, but on different days
-            d = row["End Date"]  # pd Timestamp format
-            t = row["End Time"]  # datetime.time format        
-            end_datetime = dt.datetime(d.year, d.month, d.day, t.hour, t.minute)
-            
-        return [
-            {"dateTime" : start_datetime.isoformat(), 
-             "timeZone" : row["Start Time Zone"]},
-            {"dateTime" : end_datetime.isoformat(), 
-             "timeZone" : row["End Time Zone"]}
-            ]
+def format_dates(df):
+    """
+    Create appropriate start/end info for google cal, for all rows of df at
+    once (vectorized), returns 2 lists of dicts: start, end
+    (df must have passed validate_events)
+    """
+    # Typed NumPy arrays: dates in days, times (of day) to the minute
+    start_date = to_dates(df["Start Date"])
+    end_date = to_dates(df["End Date"])
+    start_time = to_times(df["Start Time"])
+    end_time = to_times(df["End Time"])
+
+    end_date = np.where(np.isnat(end_date), start_date, end_date)  # Single-day event
+
+    # All-day events are the ones without a Start Time
+    all_day = np.isnat(start_time)
+
+    # Include Start/Stop times, default to 1-hour duration
+    start_datetime = start_date + start_time
+    end_datetime = end_date + end_time
+    end_datetime = np.where(np.isnat(end_datetime),
+                            start_datetime + np.timedelta64(1, "h"), end_datetime)
+
+    # ISO-8601 strings for the whole column at once: "2022-04-12" for dates,
+    # "2022-04-12T09:30:00" for datetimes
+    start = [ {"date" : d} if a else {"dateTime" : t, "timeZone" : tz}
+              for a, d, t, tz in zip(all_day,
+                                     np.datetime_as_string(start_date, unit="D"),
+                                     np.datetime_as_string(start_datetime, unit="s"),
+                                     df["Start Time Zone"]) ]
+    end = [ {"date" : d} if a else {"dateTime" : t, "timeZone" : tz}
+            for a, d, t, tz in zip(all_day,
+                                   np.datetime_as_string(end_date, unit="D"),
+                                   np.datetime_as_string(end_datetime, unit="s"),
+                                   df["End Time Zone"]) ]
+    return start, end
+
+
+def to_dates(dates):
+    """ Series of dates (blank=NaN) -> datetime64[D] array (blank=NaT) """
+    return pd.to_datetime(dates).to_numpy().astype("datetime64[D]")
+
+
+def to_times(times):
+    """
+    Series of datetime.time or datetime.datetime cells (blank=NaN) ->
+    timedelta64[m] array of the time of day (blank=NaT)
+    """
+    minutes = [None if pd.isna(t) else 60*t.hour + t.minute for t in times]
+    return pd.to_timedelta(minutes, unit="min").to_numpy().astype("timedelta64[m]")
+
+
+def invalid_times(times):
+    """ Boolean Series, True for the cells that are neither blank nor a time """
+    return ~times.map(lambda t: pd.isna(t) or isinstance(t, (dt.time, dt.datetime)))
 
 
 def create_new_event(row, service):
-    """ Create new Google Cal event from df row """
-    cal_id = row["id"]    
-    event_dict = dict(row[["summary", "description", "start", "end"]])
-    result = service.events().insert(calendarId=cal_id, body=event_dict).execute()
+    """ Create new Google Cal event from df row (or record dict) """
+    cal_id = row["id"]
+    event_dict = {key : row[key] for key in EVENT_FIELDS}
+    result = with_retry(service.events().insert(calendarId=cal_id, body=event_dict).execute)
     return result
 
 
+def create_events_batch(records, service, batch_size=BATCH_SIZE,
+                        max_workers=MAX_WORKERS):
+    """
+    Create new Google Cal events from a list of records (dicts with the 'id'
+    and EVENT_FIELDS of each event), sending up to 'batch_size' inserts per
+    HTTP request instead of one request per event.
+    Up to 'max_workers' batches are sent at the same time. Each worker thread
+    uses its own copy of 'service' (same account, separate connection), since
+    a service's httplib2 connection can't be shared between threads.
+    Returns a list of the created events, in the same order as records.
+    """
+    chunks = [records[i:i+batch_size] for i in range(0, len(records), batch_size)]
+    workers = min(max_workers, len(chunks))
+    if workers <= 1:  # no need for other threads/services
+        return [event for chunk in chunks for event in send_batch(chunk, service)]
+
+    # Services not in use by a thread right now (one for each worker)
+    idle_services = queue.Queue()
+    idle_services.put(service)
+    for _ in range(workers - 1):
+        idle_services.put(copy_calendar_service(service))
+
+    def send_batch_threaded(chunk):
+        thread_service = idle_services.get()
+        try:
+            return send_batch(chunk, thread_service)
+        finally:
+            idle_services.put(thread_service)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return [event for chunk_results in executor.map(send_batch_threaded, chunks)
+                for event in chunk_results]
+
+
+def copy_calendar_service(service):
+    """
+    returns a new Google Calendar 'service' for the same account as 'service',
+    with its own connection
+    """
+    return build_calendar_service(service._http.credentials)
+
+
+def send_batch(chunk, service):
+    """
+    Insert every record of 'chunk' with a single batch request.
+    Inserts that hit a rate limit are resent with exponential backoff.
+    Returns a list of the created events, in the same order as chunk.
+    """
+    results = [None] * len(chunk)
+    pending = range(len(chunk))
+    for attempt in range(MAX_RETRIES):
+        errors = {}
+
+        def collect(request_id, response, exception):
+            if exception is None:
+                results[int(request_id)] = response
+            else:
+                errors[int(request_id)] = exception
+
+        batch = service.new_batch_http_request(callback=collect)
+        for j in pending:
+            r = chunk[j]
+            event_dict = {key : r[key] for key in EVENT_FIELDS}
+            batch.add(service.events().insert(calendarId=r["id"], body=event_dict),
+                      request_id=str(j))
+        # Only retries failures of the whole batch, then no event was created
+        with_retry(batch.execute)
+
+        if not errors:
+            break
+        for error in errors.values():
+            if not is_retryable(error) or attempt == MAX_RETRIES - 1:
+                raise error
+        pending = sorted(errors)
+        backoff(attempt)
+
+    return results
+
+
+def with_retry(fn, *args, **kwargs):
+    """
+    Returns fn(*args, **kwargs), retrying with exponential backoff if it
+    fails with a rate limit or temporary server error
+    """
+    from googleapiclient.errors import HttpError
+
+    for attempt in range(MAX_RETRIES):
+        try:
+            return fn(*args, **kwargs)
+        except HttpError as error:
+            if not is_retryable(error) or attempt == MAX_RETRIES - 1:
+                raise
+            backoff(attempt)
+
+
+def is_retryable(error):
+    """ True if the (HttpError) error is a rate limit or temporary server error """
+    resp = getattr(error, 'resp', None)
+    if resp is None or resp.status not in RETRY_STATUSES:
+        return False
+    if resp.status == 403:
+        content = str(getattr(error, 'content', ''))
+        return any(reason in content for reason in RATE_LIMIT_REASONS)
+    return True
+
+
+def backoff(attempt):
+    """ Sleep before retry number 'attempt' (1s, 2s, 4s, ... plus jitter) """
+    time.sleep(min(MAX_BACKOFF, 2**attempt) + random.random())
+
+
 #%%
 # Print function that aren't needed, but they are useful when first
 # checking you are connected to the google calendar.